@@ -19,9 +19,9 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.10',
     requires=[
-        "pyzotero",
+        "pyzotero (>=1.14)",
         "click",
         "unicodecsv",
         "pandas"
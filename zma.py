@@ -22,24 +22,261 @@
 
 from dateutil.parser import parse as dateparse
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import dbm
+import functools
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import shelve
+
 import click
 from pyzotero import zotero
 import unicodecsv as csv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Number of concurrent requests to the Zotero API
+MAX_WORKERS = 8
+
+# Number of results requested per page when paging through a listing
+PAGE_SIZE = 100
+
+# Maximum number of items the Zotero API accepts in a single write request
+WRITE_BATCH_SIZE = 50
+
+# Number of times a rate-limited write request is sent before giving up
+WRITE_ATTEMPTS = 5
+
+# Tag lists are kept here between runs, keyed by library version
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'zma')
+
+# Errors from an unusable cache (unwritable, corrupt or locked), which are
+# treated as a cache miss
+CACHE_ERRORS = (OSError, ValueError, EOFError, pickle.UnpicklingError,
+                *dbm.error)
+
 # def _strip_tag_prefix(tag):
 #     new_tag = tag.strip('!@#$%^&*_')
 #     if new_tag == '': # e.g., if the source tag is "!" or "**"
 #         return tag
 #     return new_tag
 
-def _filter_tags(tags, prefixes):
-    out = []
-    for tag in tags:
-        for prefix in prefixes:
-            if tag.startswith(prefix):
-                out.append(tag)
+def _prefix_pattern(prefixes):
+    # a single compiled alternation matches a tag against all prefixes at once
+    return re.compile('|'.join(re.escape(p) for p in prefixes))
+
+# Zotero dates are most often ISO dates or bare years
+ISO_DATE = re.compile(r'^\s*(\d{4})-(\d{2})-(\d{2})\s*$')
+YEAR = re.compile(r'^\s*(\d{4})\s*$')
+
+@functools.lru_cache(maxsize=8192)
+def _parse_date(s):
+    # try the common formats before falling back on dateutil's (much slower)
+    # fuzzy parser; as with dateutil, missing fields are taken from today
+    try:
+        m = ISO_DATE.match(s)
+        if m:
+            return datetime.datetime(*[int(g) for g in m.groups()])
+        m = YEAR.match(s)
+        if m:
+            today = datetime.datetime.combine(datetime.date.today(),
+                        datetime.time())
+            return today.replace(year=int(m.group(1)))
+    except ValueError:
+        pass
+    return dateparse(s, fuzzy=True, ignoretz=True)
+
+def _sorted_difference(a, b):
+    # walk two sorted lists in step, returning the distinct values found only
+    # in a and only in b, both still sorted
+    a_only, b_only = [], []
+    i = j = 0
+    while i < len(a) or j < len(b):
+        if j == len(b) or (i < len(a) and a[i] < b[j]):
+            if not a_only or a_only[-1] != a[i]:
+                a_only.append(a[i])
+            i += 1
+        elif i == len(a) or b[j] < a[i]:
+            if not b_only or b_only[-1] != b[j]:
+                b_only.append(b[j])
+            j += 1
+        else:
+            value = a[i]
+            while i < len(a) and a[i] == value:
+                i += 1
+            while j < len(b) and b[j] == value:
+                j += 1
+    return a_only, b_only
+
+def _use_orjson():
+    # pyzotero decodes responses through its HTTP client, which calls the
+    # standard library's json.loads; route plain calls through orjson, which
+    # is several times faster on large item lists, when it is installed
+    json_loads = json.loads
+    def loads(s, **kwargs):
+        if kwargs:
+            return json_loads(s, **kwargs)
+        return orjson.loads(s)
+    json.loads = loads
+
+def _zotero_pool(obj):
+    # pyzotero keeps the state of the last request (parameters, paging links)
+    # on the instance, so concurrent requests each need their own; they all
+    # share the HTTP client of the main instance, and with it its connections
+    pool = queue.LifoQueue()
+    for _ in range(MAX_WORKERS):
+        pool.put(zotero.Zotero(obj['library_id'], obj['library_type'],
+                    obj['key'], client=obj['zot'].client))
+    return pool
+
+def _call_limited(obj, fn, **kwargs):
+    # run fn(zot, **kwargs) on an instance from the pool, waiting for one to
+    # be free, which also limits the number of concurrent requests; pyzotero
+    # waits out and retries rate-limited (429) requests itself
+    pool = obj['_zot_pool']
+    zot = pool.get()
+    try:
+        return fn(zot, **kwargs)
+    finally:
+        pool.put(zot)
+
+def _item_keys(zot, tag):
+    # 'keys' format is a plain-text list of all matching item keys,
+    # unpaginated; pyzotero may hand it back as bytes or str, and either
+    # splits into comparable keys
+    return set(zot.items(tag=tag, format='keys', limit=None).split())
+
+def _fetch_tag_keys(obj, tag):
+    return _call_limited(obj, _item_keys, tag=[tag] + obj['tag_filter'])
+
+def _page(zot, method, kwargs, start):
+    # one page of results, with the total number of results on all pages
+    results = getattr(zot, method)(start=start, limit=PAGE_SIZE, **kwargs)
+    total = int(zot.request.headers.get('Total-Results', len(results)))
+    return results, total
+
+def _fetch_page(obj, method, kwargs, start):
+    return _call_limited(obj, _page, method=method, kwargs=kwargs,
+                start=start)
+
+def _fetch_all_parallel(obj, method, **kwargs):
+    # zot.everything() follows the 'next' links one page at a time; the first
+    # page reports the total number of results, so the remaining pages can be
+    # requested by offset all at once and joined up again in order
+    first, total = _fetch_page(obj, method, kwargs, 0)
+    fetch = functools.partial(_fetch_page, obj, method, kwargs)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        pages = executor.map(fetch, range(PAGE_SIZE, total, PAGE_SIZE))
+        return first + [r for (page, _) in pages for r in page]
+
+def _tags_changed_since(zot, version):
+    # the library version also moves with changes to collections, searches and
+    # settings, which leave the tag list alone; only item changes and
+    # deletions can add or remove tags; items moved to the trash are only
+    # listed with includeTrashed
+    deleted = zot.deleted(since=version)
+    return bool(zot.item_versions(since=version, includeTrashed=1)
+                or deleted['items'] or deleted['tags'])
+
+def _fetch_prefixed_tags(obj, prefixes):
+    # the API takes a single 'q' search string, so a list of prefixes is
+    # fetched with one startsWith query per prefix and the results combined
+    if not prefixes:
+        return set(_fetch_all_parallel(obj, 'tags'))
+    fetch = lambda p: _fetch_all_parallel(obj, 'tags', q=p, qmode='startsWith')
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return set().union(*executor.map(fetch, prefixes))
+
+def _load_cached_tags(key):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with shelve.open(os.path.join(CACHE_DIR, 'tags')) as db:
+            return db.get(key)
+    except CACHE_ERRORS:
+        return None
+
+def _store_cached_tags(key, entry):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with shelve.open(os.path.join(CACHE_DIR, 'tags')) as db:
+            db[key] = entry
+    except CACHE_ERRORS:
+        pass
+
+def _get_remote_tags(ctx):
+    # Tag lists are cached for the other commands in a chained invocation, and
+    # on disk for as long as the library version is unchanged
+    tag_filter = tuple(ctx.obj['tag_filter'])
+    cache = ctx.obj['_tag_cache']
+    if tag_filter not in cache:
+        zot = ctx.obj['zot']
+        version = zot.last_modified_version()
+        # tags often contain '/', so joining the filters would let different
+        # filter lists share a key
+        key = json.dumps([ctx.obj['library_type'], ctx.obj['library_id']]
+                    + list(tag_filter))
+        cached = _load_cached_tags(key)
+        if cached and cached[0] != version \
+                and not _tags_changed_since(zot, cached[0]):
+            # nothing that affects tags has changed; restamp the entry
+            cached = (version, cached[1])
+            _store_cached_tags(key, cached)
+        if cached and cached[0] == version:
+            tags = cached[1]
+        else:
+            tags = sorted(_fetch_prefixed_tags(ctx.obj, tag_filter))
+            _store_cached_tags(key, (version, tags))
+        cache[tag_filter] = tags
+    return cache[tag_filter]
+
+def _update_items(zot, items):
+    # POST /items answers 200 even when some items are rejected (a 412 version
+    # conflict, for example), listing them under 'failed' by their index in
+    # the request; pyzotero keeps only the last response of a call, so send
+    # one request's worth of items at a time and collect the failures
+    failed = []
+    for n in range(0, len(items), WRITE_BATCH_SIZE):
+        batch = items[n:n + WRITE_BATCH_SIZE]
+        for _ in range(WRITE_ATTEMPTS):
+            # pyzotero records the backoff of a rate-limited (429) write but
+            # does not resend it; the next call waits the backoff out
+            zot.update_items(batch)
+            if zot.request.status_code != 429:
                 break
-    return out
+        else:
+            raise click.ClickException('Still rate-limited after {} '
+                        'attempts; try again later'.format(WRITE_ATTEMPTS))
+        failed.extend((batch[int(i)], error) for (i, error)
+                    in zot.request.json().get('failed', {}).items())
+    return failed
+
+def _count_journals_chunk(args):
+    # count journals for the entries dated within the range; a module-level
+    # function so that it can be run in worker processes
+    entries, start, end = args
+    journals = []
+    for (pub, pubdate) in entries:
+        if not pub:
+            continue
+        try:
+            date = _parse_date(pubdate)
+        except:
+            click.echo('Unable to parse date: {}'.format(pubdate))
+            continue
+        if date > end or date < start:
+            click.echo('Date out of range: {}'.format(pubdate))
+            continue
+        journals.append(pub)
+    return Counter(journals)
 
 # Initialize the command line interface
 # These can be written into a script and run from there...
@@ -60,6 +297,10 @@ def cli(ctx, key, library_id, library_type, tag_filter, collection_id):
     ctx.obj['library_type'] = library_type
     ctx.obj['tag_filter'] = list(tag_filter)
     ctx.obj['collection_id'] = collection_id
+    ctx.obj['_tag_cache'] = {}
+    # shared by the commands in a chained invocation
+    ctx.obj['zot'] = zotero.Zotero(library_id, library_type, key)
+    ctx.obj['_zot_pool'] = _zotero_pool(ctx.obj)
 
 
 @cli.command()
@@ -68,16 +309,13 @@ def cli(ctx, key, library_id, library_type, tag_filter, collection_id):
 def get_tags(ctx, output):
     """Print a list of tags in the library that match the input prefix.
 
-    Tags are filtered to include or exclude those that match the prefix strings
-    given. Each match is checked at the beginning of the string (left-to-right).
+    Tags are filtered to those that match any of the prefix strings given.
+    Each match is checked at the beginning of the string (left-to-right).
 
     OUTPUT can be a filename or `-` to print to stdout.
     """
 
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
-    t = zot.everything(zot.tags(q=ctx.obj['tag_filter'], qmode='startsWith'))
-    output.write('\n'.join(sorted(t)))
+    output.writelines('{}\n'.format(t) for t in _get_remote_tags(ctx))
 
 @cli.command()
 @click.pass_context
@@ -98,26 +336,24 @@ def print_bibliography(ctx, print_tag, output):
         --print-tag "#THEME:" --print-tag "+" zotero.html
     """
 
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
+    zot = ctx.obj['zot']
     t = zot.everything(zot.collection_items_top(ctx.obj['collection_id'],
                 include='bib,data', style='mla', linkwrap='1'))
     # sort by bibliography; lowercase entries to make the sort case-insensitive
     t = sorted(t, key=lambda i: i['bib'].lower())
+    pattern = _prefix_pattern(print_tag)
+    entries = []
     for i in t:
-        if print_tag:
-            tags = _filter_tags([k['tag'] for k in i['data']['tags']],
-                            print_tag)
-        else:
-            tags = i['data']['tags']
-        output.write(i['bib'])
-        output.write('<blockquote>')
-        output.write(', '.join(tags))
-        output.write('</blockquote>')
+        # an empty pattern matches every tag
+        tags = [k['tag'] for k in i['data']['tags'] if pattern.match(k['tag'])]
+        entries.append('{}<blockquote>{}</blockquote>\n'.format(i['bib'],
+                    ', '.join(tags)))
+    output.write(''.join(entries))
 
 @cli.command()
 @click.pass_context
-@click.option('--tag', required=True, help='Tag name to apply')
+@click.option('--tag', required=True, multiple=True,
+                help='Tag name to apply (can be given more than once)')
 @click.argument('input', type=click.File("r"))
 def apply_category_tags(ctx, tag, input):
     """Apply category tags to items matching tags listed in INPUT.
@@ -130,20 +366,38 @@ def apply_category_tags(ctx, tag, input):
     country names could additionally be given the tag "ASIA":
 
         python zma.py [OPTIONS] --tag ASIA asian-countries.txt
+
+    `--tag` can be given more than once to apply several tags in one pass.
     """
 
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
+    zot = ctx.obj['zot']
 
     subtags = input.read().splitlines()
     s = ' || '.join([t for t in subtags if t.strip() != ''])
     items = zot.everything(zot.items(tag=s))
 
+    tags_to_add = set(tag)
+    to_update = []
     for item in items:
-        # skip if the item already has this tag; otherwise update
-        if not any(t['tag'] == tag for t in item['data']['tags']):
+        # skip if the item already has these tags; otherwise update
+        existing = {t['tag'] for t in item['data']['tags']}
+        missing = tags_to_add - existing
+        if missing:
             click.echo('UPDATING {}'.format(item['data'].get('title', '[untitled item]')))
-            zot.add_tags(item, tag)
+            item['data']['tags'].extend({'tag': t} for t in sorted(missing))
+            to_update.append(item['data'])
+
+    failed = _update_items(zot, to_update)
+    if to_update:
+        # tag lists fetched earlier in a chained invocation are now stale
+        ctx.obj['_tag_cache'].clear()
+    for (data, error) in failed:
+        click.echo('FAILED {}: {} ({})'.format(
+                    data.get('title', '[untitled item]'),
+                    error.get('message'), error.get('code')))
+    if failed:
+        raise click.ClickException(
+                    '{} items could not be updated'.format(len(failed)))
 
 
 @cli.command()
@@ -156,7 +410,7 @@ def apply_category_tags(ctx, tag, input):
                 help='Output for tags missing in the Zotero library',
                 show_default=True)
 @click.argument('tags_list', type=click.File("r"))
-def find_missing_tags(ctx, match, local, remote, tags_list):
+def find_missing_tags(ctx, local, remote, tags_list):
     """Compare a list of tags to those in the library.
 
     Prints lists of tags to two plain text files, by default "missing-user-
@@ -173,19 +427,18 @@ def find_missing_tags(ctx, match, local, remote, tags_list):
 
     """
 
-    local_tags = tags_list.read().splitlines()
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
-    remote_tags = zot.everything(zot.tags(q=ctx.obj['tag_filter'], qmode='startsWith'))
+    local_tags = sorted(tags_list.read().splitlines())
+    remote_tags = _get_remote_tags(ctx) # already sorted
 
-    local_only = [l for l in local_tags if not l in remote_tags]
-    remote_only = [r for r in remote_tags if not r in local_tags]
+    # tags in the user-supplied file that are missing in the Zotero library,
+    # and tags in the Zotero library that are missing in the file
+    missing_remote, missing_local = _sorted_difference(local_tags, remote_tags)
 
     with open(remote, 'w') as out:
-        out.write('\n'.join(sorted(local_only)))
+        out.write('\n'.join(missing_remote))
 
     with open(local, 'w') as out:
-        out.write('\n'.join(sorted(remote_only)))
+        out.write('\n'.join(missing_local))
 
 @cli.command()
 @click.pass_context
@@ -212,66 +465,58 @@ def get_union(ctx, tag_x, tag_y, output):
     tags_x = tag_x.read().splitlines()
     tags_y = tag_y.read().splitlines()
 
-    fieldnames = ['tag'] + tags_x
-    csvwriter = csv.DictWriter(output, fieldnames=fieldnames)
-    csvwriter.writeheader()
-    rows = []
+    csvwriter = csv.writer(output)
+    csvwriter.writerow(['tag'] + tags_x)
 
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
-    for y in tags_y:
-        row = {'tag': y}
-        for x in tags_x:
-            t = zot.everything(zot.items(tag=[x,y] + ctx.obj['tag_filter'],
-                format='versions',
-                limit=None))
-            row[x] = len(t)
-        rows.append(row)
+    # fetch the matching item keys once per tag, then count co-occurrences
+    # locally instead of querying the API for every (x, y) pair
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(_fetch_tag_keys, ctx.obj, t): t
+                    for t in set(tags_x) | set(tags_y)}
+        item_keys = {futures[f]: f.result() for f in as_completed(futures)}
 
-    for row in rows:
-        csvwriter.writerow(row)
+    for y in tags_y:
+        csvwriter.writerow([y] + [len(item_keys[x] & item_keys[y])
+                    for x in tags_x])
 
 @cli.command()
 @click.pass_context
 @click.option('--start-date', default='1900', show_default=True)
 @click.option('--end-date', default='2100', show_default=True)
+@click.option('--jobs', default=1, show_default=True,
+                type=click.IntRange(min=1),
+                help='Number of worker processes for counting journals')
 @click.argument('output', type=click.File('wb'))
-def list_journals(ctx, start_date, end_date, output):
+def list_journals(ctx, start_date, end_date, jobs, output):
     """Write a table showing journal frequencies.
 
     Tag filters can be used to limit results. The filter argument can only be
     specified once, otherwise it will be ignored.
     """
-    pubs = {}
     end = dateparse(end_date, ignoretz=True)
     start = dateparse(start_date, ignoretz=True)
-    zot = zotero.Zotero(ctx.obj['library_id'], ctx.obj['library_type'],
-                    ctx.obj['key'])
-    items = zot.everything(zot.items(   tag=ctx.obj['tag_filter'],
-                                        itemType='journalArticle'))
-
-    for i in items:
-        data = i['data']
-        pub = data.get('publicationTitle', None)
-        if not pub:
-            continue
-        pubdate = data.get('date', 'None') #use 'None' as string for error message
-        try:
-            date = dateparse(pubdate, fuzzy=True, ignoretz=True)
-        except:
-            click.echo('Unable to parse date: {}'.format(pubdate))
-            continue
-        if date > end or date < start:
-            click.echo('Date out of range: {}'.format(pubdate))
-            continue
-        if not pub in pubs:
-            pubs[pub] = 0
-        pubs[pub] += 1
+    items = _fetch_all_parallel(ctx.obj, 'items', tag=ctx.obj['tag_filter'],
+                itemType='journalArticle')
+
+    # only the journal and date are needed, which keeps the data sent to
+    # worker processes small; use 'None' as string for error message
+    entries = [(i['data'].get('publicationTitle', None),
+                i['data'].get('date', 'None')) for i in items]
+    if jobs == 1:
+        pubs = _count_journals_chunk((entries, start, end))
+    else:
+        chunks = [(entries[n::jobs], start, end) for n in range(jobs)]
+        with multiprocessing.Pool(jobs) as pool:
+            pubs = sum(pool.map(_count_journals_chunk, chunks), Counter())
 
     csvwriter = csv.writer(output)
     csvwriter.writerow(['count', 'journal'])
-    for (pub, count) in pubs.items():
-        csvwriter.writerow([count, pub])
+    # most_common() orders ties as they were counted, which depends on how
+    # the entries were split between jobs; break ties by journal name instead
+    csvwriter.writerows([(count, pub) for (pub, count)
+                in sorted(pubs.items(), key=lambda pc: (-pc[1], pc[0]))])
 
 if __name__ == '__main__':
+    if orjson is not None:
+        _use_orjson()
     cli()